@@ -10,7 +10,7 @@ from transformers import (AutoModelForCausalLM, AutoTokenizer, GPT2LMHeadModel,
                           GPTJForCausalLM, GPTNeoXForCausalLM,
                           LlamaForCausalLM)
 from BOOST.Attack_GCG.gcg_utils import get_nonascii_toks, verify_input, get_embedding_weight, get_embeddings, get_fixed_list, chatgpt_evaluate
-from BOOST.utils.templates import get_templates, get_end_tokens, get_eos
+from BOOST.utils.templates import get_templates, get_end_tokens, get_eos, render
 from BOOST.utils.constants import get_black_list
 
 def token_gradients(model, input_ids, target_tokens, input_slice, loss_slice):
@@ -470,7 +470,7 @@ class GCG:
                                 current_control_str = self.question + ' ' + current_control_str
 
                             print("Current_control_str:", current_control_str)
-                            current_full_string = self.chat_prompt['prompt'].format(instruction=current_control_str)
+                            current_full_string = render(self.args.model_path, 'chat', current_control_str)
                             current_full_toks = self.tokenizer(current_full_string, return_tensors="pt")
                             current_full_toks['input_ids'] = current_full_toks['input_ids'].cuda()
                             current_full_toks['attention_mask'] = current_full_toks['attention_mask'].cuda()
@@ -1,14 +1,51 @@
+import asyncio
+import copy
+import functools
+import random
+import re
+import httpx
 import torch
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from fastchat.model import load_model, get_conversation_template
+from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
 import logging
 import time
-import concurrent.futures
 from vllm import LLM as vllm
 from vllm import SamplingParams
 from BOOST.utils.constants import *
-from anthropic import Anthropic, HUMAN_PROMPT, AI_PROMPT
+from anthropic import Anthropic, AsyncAnthropic, HUMAN_PROMPT, AI_PROMPT
 import google.generativeai as genai
+import ahocorasick
+
+# multi-pattern matcher over the refusal black list, built once at import;
+# scans a generation in a single pass regardless of how many phrases the
+# black list contains
+_BLACK_LIST_AUTOMATON = ahocorasick.Automaton()
+for _black in get_black_list():
+    _BLACK_LIST_AUTOMATON.add_word(_black, _black)
+_BLACK_LIST_AUTOMATON.make_automaton()
+
+# generous keep-alive pool so retries and concurrent batch calls reuse warm
+# connections instead of paying a TLS handshake each time
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=100)
+_HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+@functools.lru_cache(maxsize=1024)
+def _question_tokens(question):
+    # predict is called once per generated sample but the question barely
+    # changes across a run, so memoize the token set
+    return frozenset(re.findall(r'\w+', question.lower()))
+
+def _dedupe_prompts(prompts):
+    # fuzzing loops resubmit unmutated seeds verbatim, so only run inference
+    # on unique prompts; returns the unique list plus, for each original
+    # prompt, its index into that list
+    uniq = {}
+    order = []
+    for prompt in prompts:
+        uniq.setdefault(prompt, len(uniq))
+        order.append(uniq[prompt])
+    return list(uniq), order
 
 class LLM:
     def __init__(self):
@@ -33,22 +70,12 @@ class LocalLLM(LLM):
                  cpu_offloading=False,
                  revision=None,
                  debug=False,
-                 system_message=None
+                 system_message=None,
+                 engine='vllm'
                  ):
         super().__init__()
-
-        self.model, self.tokenizer = self.create_model(
-            model_path,
-            device,
-            num_gpus,
-            max_gpu_memory,
-            dtype,
-            load_8bit,
-            cpu_offloading,
-            revision=revision,
-            debug=debug,
-        )
         self.model_path = model_path
+        self.engine = engine
 
         if system_message is None and 'Llama-2' in model_path:
             # monkey patch for latest FastChat to use llama2's official system message
@@ -60,6 +87,51 @@ class LocalLLM(LLM):
         else:
             self.system_message = system_message
 
+        if engine == 'vllm':
+            # delegate to vLLM so batched generation gets continuous batching
+            # and PagedAttention instead of the slow HF generate path
+            self._vllm = LocalVLLM(
+                model_path, gpu_memory_utilization=0.95, system_message=self.system_message)
+        elif engine == 'hf':
+            # slow HF path, kept for debugging
+            self.model, self.tokenizer = self.create_model(
+                model_path,
+                device,
+                num_gpus,
+                max_gpu_memory,
+                dtype,
+                load_8bit,
+                cpu_offloading,
+                revision=revision,
+                debug=debug,
+            )
+            # tokenized conversation scaffolds (system message + role markers),
+            # keyed by the scaffold string; shared by every prompt in a batch
+            self._prefix_ids_cache = {}
+            if self.tokenizer.pad_token == None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            # validated once here instead of per call; greedy decoding needs
+            # no temperature or repetition penalty (they only feed dead
+            # logits warpers when do_sample=False)
+            self.gen_cfg_greedy = GenerationConfig(
+                do_sample=False,
+                max_new_tokens=512,
+                pad_token_id=self.tokenizer.pad_token_id,
+                use_cache=True,
+                num_beams=1,
+            )
+            # switch the CUDA caching allocator to expandable segments after
+            # the weights are loaded (so they stay in normal, IPC-compatible
+            # segments); per-batch activations vary in padded shape and
+            # fragment fixed-size segments badly enough to OOM with free memory
+            try:
+                torch.cuda.memory._set_allocator_settings("expandable_segments:True")
+            except (AttributeError, RuntimeError):
+                # older torch without expandable segments support
+                pass
+        else:
+            raise ValueError(f'Unknown engine {engine}, should be one of "vllm", "hf"')
+
     @torch.inference_mode()
     def create_model(self, model_path,
                      device='cuda',
@@ -70,6 +142,26 @@ class LocalLLM(LLM):
                      cpu_offloading=False,
                      revision=None,
                      debug=False):
+        if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+            # Ampere and newer: bf16 keeps fp16 throughput with fp32 dynamic
+            # range, and FlashAttention-2 fuses the attention softmax+matmul
+            if dtype == torch.float16:
+                dtype = torch.bfloat16
+            try:
+                model = AutoModelForCausalLM.from_pretrained(
+                    model_path,
+                    torch_dtype=dtype,
+                    attn_implementation='flash_attention_2',
+                    device_map='auto',
+                    revision=revision,
+                )
+                tokenizer = AutoTokenizer.from_pretrained(model_path, revision=revision)
+                return model, tokenizer
+            except (ImportError, ValueError) as e:
+                logging.warning(
+                    f"flash_attention_2 unavailable for {model_path} ({e}), "
+                    "falling back to the fastchat loader")
+
         model, tokenizer = load_model(
             model_path,
             device,
@@ -90,6 +182,11 @@ class LocalLLM(LLM):
 
     @torch.inference_mode()
     def generate(self, prompt, temperature=0.01, max_tokens=512, repetition_penalty=1.0):
+        if self.engine == 'vllm':
+            # the HF path decodes greedily regardless of temperature, so keep
+            # the same semantics (and the temperature==0 dedupe) here
+            return self._vllm.generate(prompt, 0, max_tokens)[0]
+
         conv_temp = get_conversation_template(self.model_path)
         self.set_system_message(conv_temp)
 
@@ -97,19 +194,18 @@ class LocalLLM(LLM):
         conv_temp.append_message(conv_temp.roles[1], None)
 
         prompt_input = conv_temp.get_prompt()
-        input_ids = self.tokenizer([prompt_input]).input_ids
+        enc = self.tokenizer([prompt_input], return_tensors='pt')
         output_ids = self.model.generate(
-            torch.as_tensor(input_ids).cuda(),
-            do_sample=False,
-            temperature=temperature,
-            repetition_penalty=repetition_penalty,
+            enc.input_ids.to('cuda', non_blocking=True),
+            attention_mask=enc.attention_mask.cuda(),
+            generation_config=self.gen_cfg_greedy,
             max_new_tokens=max_tokens
         )
 
         if self.model.config.is_encoder_decoder:
             output_ids = output_ids[0]
         else:
-            output_ids = output_ids[0][len(input_ids[0]):]
+            output_ids = output_ids[0][enc.input_ids.shape[1]:]
 
         return self.tokenizer.decode(
             output_ids, skip_special_tokens=True, spaces_between_special_tokens=False
@@ -117,35 +213,74 @@ class LocalLLM(LLM):
 
     @torch.inference_mode()
     def generate_batch(self, prompts, temperature=0.01, max_tokens=512, repetition_penalty=1.0, batch_size=16):
-        prompt_inputs = []
-        for prompt in prompts:
-            conv_temp = get_conversation_template(self.model_path)
-            self.set_system_message(conv_temp)
-
-            conv_temp.append_message(conv_temp.roles[0], prompt)
-            conv_temp.append_message(conv_temp.roles[1], None)
-
-            prompt_input = conv_temp.get_prompt()
-            prompt_inputs.append(prompt_input)
-
-        if self.tokenizer.pad_token == None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
-        self.tokenizer.padding_side = "left"
-        input_ids = self.tokenizer(prompt_inputs, padding=True).input_ids
-        # load the input_ids batch by batch to avoid OOM
-        outputs = []
-        for i in range(0, len(input_ids), batch_size):
+        if self.engine == 'vllm':
+            # greedy like the HF path; see generate
+            return self._vllm.generate_batch(prompts, 0, max_tokens)
+
+        # the HF path always decodes greedily, so duplicates are safe to
+        # collapse regardless of the temperature argument
+        prompts, order = _dedupe_prompts(prompts)
+
+        # build the template once; get_conversation_template deep-copies the
+        # registered template on every call, which adds up in fuzzing loops
+        base_conv = get_conversation_template(self.model_path)
+        self.set_system_message(base_conv)
+        # every prompt shares the same scaffold around the user text, so split
+        # the template once with a sentinel user message and tokenize the
+        # scaffold prefix a single time instead of once per prompt per call
+        probe = copy.copy(base_conv)
+        probe.messages = []
+        probe.append_message(probe.roles[0], '\x00')
+        probe.append_message(probe.roles[1], None)
+        prefix_str, suffix_str = probe.get_prompt().split('\x00')
+        if prefix_str not in self._prefix_ids_cache:
+            self._prefix_ids_cache[prefix_str] = self.tokenizer(prefix_str).input_ids
+        prefix_ids = self._prefix_ids_cache[prefix_str]
+
+        pad_id = self.tokenizer.pad_token_id
+        user_ids = self.tokenizer(
+            [prompt + suffix_str for prompt in prompts], add_special_tokens=False).input_ids
+        input_rows = [prefix_ids + ids for ids in user_ids]
+
+        # batch by batch to avoid OOM, left-padding each batch to its own max
+        # length rather than the global one; walking the rows in length order
+        # groups similar lengths together so one long prompt no longer forces
+        # padding onto a whole batch of short ones
+        sort_order = sorted(range(len(input_rows)), key=lambda i: len(input_rows[i]))
+        outputs = [None] * len(input_rows)
+        # stage batches in pinned host memory and copy on a dedicated stream,
+        # so the H2D transfer overlaps the tail of the previous generate call
+        # instead of stalling the compute stream
+        copy_stream = torch.cuda.Stream()
+        copy_done = torch.cuda.Event()
+        for i in range(0, len(sort_order), batch_size):
+            bucket = sort_order[i:i+batch_size]
+            rows = [input_rows[j] for j in bucket]
+            width = max(len(row) for row in rows)
+            input_ids = torch.full(
+                (len(rows), width), pad_id, dtype=torch.long, pin_memory=True)
+            attention_mask = torch.zeros(
+                (len(rows), width), dtype=torch.long, pin_memory=True)
+            for j, row in enumerate(rows):
+                input_ids[j, width-len(row):] = torch.as_tensor(row)
+                attention_mask[j, width-len(row):] = 1
+            with torch.cuda.stream(copy_stream):
+                input_ids_gpu = input_ids.to('cuda', non_blocking=True)
+                attention_mask_gpu = attention_mask.to('cuda', non_blocking=True)
+            copy_done.record(copy_stream)
+            torch.cuda.current_stream().wait_event(copy_done)
             output_ids = self.model.generate(
-                torch.as_tensor(input_ids[i:i+batch_size]).cuda(),
-                do_sample=False,
-                temperature=temperature,
-                repetition_penalty=repetition_penalty,
+                input_ids_gpu,
+                attention_mask=attention_mask_gpu,
+                generation_config=self.gen_cfg_greedy,
                 max_new_tokens=max_tokens,
             )
-            output_ids = output_ids[:, len(input_ids[0]):]
-            outputs.extend(self.tokenizer.batch_decode(
-                output_ids, skip_special_tokens=True, spaces_between_special_tokens=False))
-        return outputs
+            output_ids = output_ids[:, width:]
+            decoded = self.tokenizer.batch_decode(
+                output_ids, skip_special_tokens=True, spaces_between_special_tokens=False)
+            for j, text in zip(bucket, decoded):
+                outputs[j] = text
+        return [outputs[i] for i in order]
 
 
 class ClaudeLLM(LLM):
@@ -160,9 +295,17 @@ class ClaudeLLM(LLM):
         
         self.model_path = model_path
         self.api_key = api_key
+        # our retry loop owns the budget, so disable the SDK's own retries
         self.anthropic = Anthropic(
-            api_key=self.api_key
+            api_key=self.api_key, max_retries=0, timeout=60
+        )
+        self.async_anthropic = AsyncAnthropic(
+            api_key=self.api_key, max_retries=0, timeout=60
         )
+        # one long-lived loop per instance: the async client's keep-alive
+        # connections are bound to the loop they were opened on, and would
+        # all be dead on the second call if each batch ran asyncio.run
+        self._loop = asyncio.new_event_loop()
 
     def generate(self, prompt, max_tokens=512, max_trials=1, failure_sleep_time=1):
         
@@ -181,22 +324,64 @@ class ClaudeLLM(LLM):
 
         return [" "]
     
-    def generate_batch(self, prompts, max_tokens=512, max_trials=1, failure_sleep_time=1):
-        results = []
-        for prompt in prompts:
-            results.extend(self.generate(prompt, max_tokens, max_trials, failure_sleep_time))
-        return results
+    def generate_batch(self, prompts, max_tokens=512, max_trials=1, failure_sleep_time=1, concurrency=8):
+        async def _one(prompt, sem):
+            async with sem:
+                for _ in range(max_trials):
+                    try:
+                        completion = await self.async_anthropic.completions.create(
+                            model=self.model_path,
+                            max_tokens_to_sample=max_tokens,
+                            prompt=f"{HUMAN_PROMPT} {prompt}{AI_PROMPT}",
+                        )
+                        return [completion.completion]
+                    except Exception as e:
+                        logging.warning(
+                            f"Claude API call failed due to {e}. Retrying {_+1} / {max_trials} times...")
+                        await asyncio.sleep(failure_sleep_time * 2 ** _ + random.random())
+                return [" "]
+
+        async def _all():
+            sem = asyncio.Semaphore(concurrency)
+            return await asyncio.gather(*[_one(prompt, sem) for prompt in prompts])
+
+        # gather preserves prompt order, unlike as_completed
+        results = self._loop.run_until_complete(_all())
+        return [output for result in results for output in result]
 
 class LocalVLLM(LLM):
     def __init__(self,
                  model_path,
-                 gpu_memory_utilization=0.98,
+                 gpu_memory_utilization=0.9,
+                 max_num_seqs=256,
+                 block_size=16,
+                 max_model_len=None,
+                 enforce_eager=False,
                  system_message=None
                  ):
         super().__init__()
         self.model_path = model_path
+        # keep gpu_memory_utilization below ~0.95: activation and CUDA-graph
+        # memory is only profiled approximately and 0.98 OOMs at startup.
+        # For offline bulk runs, max_num_seqs=512, block_size=32 and
+        # gpu_memory_utilization=0.93 trade latency for throughput.
+        if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+            dtype = 'bfloat16'
+        else:
+            dtype = 'auto'
         self.model = vllm(
-            self.model_path, gpu_memory_utilization=gpu_memory_utilization)
+            self.model_path,
+            gpu_memory_utilization=gpu_memory_utilization,
+            max_num_seqs=max_num_seqs,
+            block_size=block_size,
+            max_model_len=max_model_len,
+            enforce_eager=enforce_eager,
+            # prompts in a batch share the system scaffold, so cached KV
+            # blocks for the common prefix are reused across sequences
+            enable_prefix_caching=True,
+            dtype=dtype)
+        # SamplingParams reused across calls, keyed by (temperature, max_tokens)
+        self._sp_cache = {}
         
         if system_message is None and 'Llama-2' in model_path:
             # monkey patch for latest FastChat to use llama2's official system message
@@ -218,23 +403,33 @@ class LocalVLLM(LLM):
 
     def generate_batch(self, prompts, temperature=0, max_tokens=512):
         prompt_inputs = []
+        # build the template once per batch, see LocalLLM.generate_batch
+        base_conv = get_conversation_template(self.model_path)
+        self.set_system_message(base_conv)
         for prompt in prompts:
-            conv_temp = get_conversation_template(self.model_path)
-            self.set_system_message(conv_temp)
-
+            conv_temp = copy.copy(base_conv)
+            conv_temp.messages = []
             conv_temp.append_message(conv_temp.roles[0], prompt)
             conv_temp.append_message(conv_temp.roles[1], None)
 
             prompt_input = conv_temp.get_prompt()
             prompt_inputs.append(prompt_input)
 
-        sampling_params = SamplingParams(temperature=temperature, max_tokens=max_tokens)
+        # duplicates only collapse under deterministic decoding; sampled
+        # generations should stay independent per prompt
+        if temperature == 0:
+            prompt_inputs, order = _dedupe_prompts(prompt_inputs)
+        else:
+            order = range(len(prompt_inputs))
+
+        key = (temperature, max_tokens)
+        sampling_params = self._sp_cache.get(key)
+        if sampling_params is None:
+            sampling_params = self._sp_cache.setdefault(
+                key, SamplingParams(temperature=temperature, max_tokens=max_tokens))
         results = self.model.generate(
             prompt_inputs, sampling_params, use_tqdm=False)
-        outputs = []
-        for result in results:
-            outputs.append(result.outputs[0].text)
-        return outputs
+        return [results[i].outputs[0].text for i in order]
 
 class OpenAILLM(LLM):
     def __init__(self,
@@ -246,7 +441,14 @@ class OpenAILLM(LLM):
 
         if not api_key.startswith('sk-'):
             raise ValueError('OpenAI API key should start with sk-')
-        self.client = OpenAI(api_key = api_key)
+        self.client = OpenAI(
+            api_key=api_key,
+            http_client=httpx.Client(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT))
+        self.aclient = AsyncOpenAI(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT))
+        # one long-lived loop per instance, see ClaudeLLM
+        self._loop = asyncio.new_event_loop()
         self.model_path = model_path
         self.system_message = system_message if system_message is not None else "You are a helpful assistant."
 
@@ -271,28 +473,51 @@ class OpenAILLM(LLM):
 
         return [" " for _ in range(n)]
 
-    def generate_batch(self, prompts, temperature=0, max_tokens=512, n=1, max_trials=10, failure_sleep_time=5):
-        results = []
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = {executor.submit(self.generate, prompt, temperature, max_tokens, n,
-                                       max_trials, failure_sleep_time): prompt for prompt in prompts}
-            for future in concurrent.futures.as_completed(futures):
-                results.extend(future.result())
-        return results
-            
+    def generate_batch(self, prompts, temperature=0, max_tokens=512, n=1, max_trials=10, failure_sleep_time=5, concurrency=16):
+        if temperature == 0:
+            prompts, order = _dedupe_prompts(prompts)
+        else:
+            order = range(len(prompts))
+
+        async def _one(prompt, sem):
+            async with sem:
+                for _ in range(max_trials):
+                    try:
+                        results = await self.aclient.chat.completions.create(
+                            model=self.model_path,
+                            messages=[
+                                {"role": "system", "content": self.system_message},
+                                {"role": "user", "content": prompt},
+                            ],
+                            temperature=temperature,
+                            max_tokens=max_tokens,
+                            n=n,
+                        )
+                        return [results.choices[i].message.content for i in range(n)]
+                    except Exception as e:
+                        logging.warning(
+                            f"OpenAI API call failed due to {e}. Retrying {_+1} / {max_trials} times...")
+                        # exponential backoff with jitter so concurrent retries spread out
+                        await asyncio.sleep(failure_sleep_time * 2 ** _ + random.random())
+                return [" " for _ in range(n)]
+
+        async def _all():
+            sem = asyncio.Semaphore(concurrency)
+            return await asyncio.gather(*[_one(prompt, sem) for prompt in prompts])
+
+        # gather preserves prompt order, unlike as_completed
+        results = self._loop.run_until_complete(_all())
+        return [output for i in order for output in results[i]]
+
     def predict(self, sequences, question):
-        black_list = get_black_list()
         # check if any black list in the sequences
-        for black in black_list:
-            if black in sequences[0]:
-                return [0]
-        # verify whether the generation is related with the target
-        split = question.split()
-        cnt = 0
-        for word in split:
-            if word in sequences[0]:
-                cnt += 1
-        if cnt/len(split) < 0.5:
+        if next(_BLACK_LIST_AUTOMATON.iter(sequences[0]), None) is not None:
+            return [0]
+        # verify whether the generation is related with the target; compare
+        # case-folded word tokens so punctuation and casing don't mask overlap
+        q_tokens = _question_tokens(question)
+        seq_tokens = set(re.findall(r'\w+', sequences[0].lower()))
+        if len(q_tokens & seq_tokens) / max(len(q_tokens), 1) < 0.5:
             return [0]
         prediction = self.generate(sequences[0])
         for i in range(len(prediction)):
@@ -317,8 +542,12 @@ class GeminiLLM(LLM):
         
         self.model_path = model_path
         self.api_key = api_key
-        genai.configure(api_key=api_key)
+        # REST transport keeps one keep-alive connection instead of
+        # re-establishing a gRPC channel on retries
+        genai.configure(api_key=api_key, transport='rest')
         self.gemini = genai.GenerativeModel(self.model_path)
+        # one long-lived loop per instance, see ClaudeLLM
+        self._loop = asyncio.new_event_loop()
 
     def generate(self, prompt, max_tokens=512, max_trials=1, failure_sleep_time=1):
      
@@ -334,11 +563,24 @@ class GeminiLLM(LLM):
 
         return [" "]
     
-    def generate_batch(self, prompts, max_tokens=512, max_trials=1, failure_sleep_time=1):
-        results = []
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = {executor.submit(self.generate, prompt, max_tokens,
-                                       max_trials, failure_sleep_time): prompt for prompt in prompts}
-            for future in concurrent.futures.as_completed(futures):
-                results.extend(future.result())
-        return results
\ No newline at end of file
+    def generate_batch(self, prompts, max_tokens=512, max_trials=1, failure_sleep_time=1, concurrency=8):
+        async def _one(prompt, sem):
+            async with sem:
+                for _ in range(max_trials):
+                    try:
+                        completion = await self.gemini.generate_content_async(
+                            f"{HUMAN_PROMPT} {prompt}{AI_PROMPT}", max_tokens=max_tokens)
+                        return [completion.text]
+                    except Exception as e:
+                        logging.warning(
+                            f"Gemini API call failed due to {e}. Retrying {_+1} / {max_trials} times...")
+                        await asyncio.sleep(failure_sleep_time * 2 ** _ + random.random())
+                return [" "]
+
+        async def _all():
+            sem = asyncio.Semaphore(concurrency)
+            return await asyncio.gather(*[_one(prompt, sem) for prompt in prompts])
+
+        # gather preserves prompt order, unlike as_completed
+        results = self._loop.run_until_complete(_all())
+        return [output for result in results for output in result]
\ No newline at end of file
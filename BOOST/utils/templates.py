@@ -1,3 +1,5 @@
+import functools
+
 LLAMA2_PROMPT_GCG = {
     "description": "Llama 2 GCG prompt",
     "prompt": '''[INST] <<SYS>>
@@ -132,85 +134,103 @@ LLAMA3_8B_PROMPT_GCG = {
 '''
 }
 
-def get_templates(model_path, func):
-    if 'Llama-2' in model_path:
-        if func == 'GCG':
-            return LLAMA2_PROMPT_GCG
-        elif func == 'chat':
-            return LLAMA2_PROMPT
-        else:
-            raise ValueError(f'Unknown function {func}, should be one of "GCG", "chat"')
-    elif 'mpt' in model_path:
-        if func == 'GCG':
-            return MPT_7B_PROMPT_GCG
-        elif func == 'chat':
-            return MPT_7B_PROMPT
+# compiled prompt renderers, keyed by (model_path, func); each entry is a
+# callable that concatenates the pre-split template around the instruction,
+# so hot loops skip re-parsing the format string on every prompt
+_COMPILED = {}
+
+def render(model_path, func, instruction):
+    key = (model_path, func)
+    compiled = _COMPILED.get(key)
+    if compiled is None:
+        template = get_templates(model_path, func)['prompt']
+        if '{instruction}' in template:
+            prefix, suffix = template.split('{instruction}')
+            compiled = lambda inst: prefix + inst + suffix
         else:
-            raise ValueError(f'Unknown function {func}, should be one of "GCG", "chat"')
-    elif 'gemma' in model_path:
-        if func == 'GCG':
-            return GEMMA_7B_PROMPT_GCG
-        elif func == 'chat':
-            return GEMMA_7B_PROMPT
-    elif 'Qwen' in model_path:
-        if func == 'GCG':
-            return QWEN_7B_PROMPT_GCG
-        elif func == 'chat':
-            return QWEN_7B_PROMPT
-    elif 'tulu' in model_path:
-        if func == 'GCG':
-            return TULU_7B_PROMPT_GCG
-        elif func == 'chat':
-            return TULU_7B_PROMPT
-    elif 'mistral' in model_path:
-        if func == 'GCG':
-            return MISTRAL_7B_PROMPT_GCG
-        elif func == 'chat':
-            return MISTRAL_7B_PROMPT
-    elif 'vicuna' in model_path:
-        if func == 'GCG':
-            return VICUNA_7B_PROMPT_GCG
-        elif func == 'chat':
-            return VICUNA_7B_PROMPT
-    elif 'Llama-3' in model_path:
-        if func == 'chat':
-            return LLAMA3_8B_PROMPT
-        elif func == 'GCG':
-            return LLAMA3_8B_PROMPT_GCG
-    else:
+            # GCG templates have no instruction slot, cache the string as-is
+            compiled = lambda inst: template
+        _COMPILED[key] = compiled
+    return compiled(instruction)
+
+# model family detection, ordered: the first substring hit wins, mirroring
+# the precedence of the old elif chains
+_FAMILIES = [
+    ('Llama-2', 'llama2'),
+    ('Llama-3', 'llama3'),
+    ('mpt', 'mpt'),
+    ('gemma', 'gemma'),
+    ('Qwen', 'qwen'),
+    ('tulu', 'tulu'),
+    ('mistral', 'mistral'),
+    ('vicuna', 'vicuna'),
+    ('gpt', 'gpt'),
+    ('falcon', 'falcon'),
+    ('claude', 'claude'),
+]
+
+_TEMPLATES = {
+    'llama2': {'GCG': LLAMA2_PROMPT_GCG, 'chat': LLAMA2_PROMPT},
+    'llama3': {'GCG': LLAMA3_8B_PROMPT_GCG, 'chat': LLAMA3_8B_PROMPT},
+    'mpt': {'GCG': MPT_7B_PROMPT_GCG, 'chat': MPT_7B_PROMPT},
+    'gemma': {'GCG': GEMMA_7B_PROMPT_GCG, 'chat': GEMMA_7B_PROMPT},
+    'qwen': {'GCG': QWEN_7B_PROMPT_GCG, 'chat': QWEN_7B_PROMPT},
+    'tulu': {'GCG': TULU_7B_PROMPT_GCG, 'chat': TULU_7B_PROMPT},
+    'mistral': {'GCG': MISTRAL_7B_PROMPT_GCG, 'chat': MISTRAL_7B_PROMPT},
+    'vicuna': {'GCG': VICUNA_7B_PROMPT_GCG, 'chat': VICUNA_7B_PROMPT},
+}
+
+_EOS = {
+    'llama2': '</s>',
+    'tulu': '</s>',
+    'mistral': '</s>',
+    'vicuna': '</s>',
+    'mpt': '<|endoftext|>',
+    'gpt': '<|endoftext|>',
+    'qwen': '<|endoftext|>',
+    'falcon': '<|endoftext|>',
+    'gemma': '<eos>',
+    'claude': '<EOT>',
+    'llama3': '<|end_of_text|>',
+}
+
+_END_TOKENS = {
+    'llama2': ' [/INST] ',
+    'mpt': '<|im_end|>\n<|im_start|>assistant\n',
+    'qwen': '<|im_end|>\n<|im_start|>assistant\n',
+    'gemma': '<end_of_turn>\n<start_of_turn>model\n',
+    'tulu': '\n<|assistant|>\n',
+    'mistral': ' [/INST]',
+    'vicuna': ' ASSISTANT:',
+    'llama3': '<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n',
+}
+
+@functools.lru_cache(maxsize=64)
+def _family(model_path):
+    for sub, family in _FAMILIES:
+        if sub in model_path:
+            return family
+    return None
+
+def get_templates(model_path, func):
+    templates = _TEMPLATES.get(_family(model_path))
+    if templates is None:
         raise ValueError(f'Unknown model {model_path})')
-    
+    if func not in templates:
+        raise ValueError(f'Unknown function {func}, should be one of "GCG", "chat"')
+    return templates[func]
+
 def get_eos(model_path):
-    if 'Llama-2' in model_path or 'tulu' in model_path or 'mistral' in model_path or 'vicuna' in model_path:
-        return '</s>'
-    elif 'mpt' in model_path or 'gpt' in model_path or 'Qwen' in model_path or 'falcon' in model_path:
-        return '<|endoftext|>'
-    elif 'gemma' in model_path:
-        return '<eos>'
-    elif 'claude' in model_path:
-      return '<EOT>'
-    elif 'Llama-3' in model_path:
-        return '<|end_of_text|>'
-    else:
+    eos = _EOS.get(_family(model_path))
+    if eos is None:
         raise ValueError(f'Unknown model {model_path}, plz set the eos token manually')
-    
+    return eos
+
 def get_end_tokens(model_path):
-    if 'Llama-2' in model_path:
-        return ' [/INST] '
-    elif 'mpt' in model_path or 'Qwen' in model_path:
-        return '<|im_end|>\n<|im_start|>assistant\n'
-    elif 'gemma' in model_path:
-        return '<end_of_turn>\n<start_of_turn>model\n'
-    elif 'tulu' in model_path:
-        return '\n<|assistant|>\n'
-    elif 'mistral' in model_path:
-        return ' [/INST]'
-    elif 'vicuna' in model_path:
-        return ' ASSISTANT:'
-    elif 'Llama-3' in model_path:
-        return '<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n'
-    else:
+    end_tokens = _END_TOKENS.get(_family(model_path))
+    if end_tokens is None:
         raise ValueError(f'Unknown model {model_path}, plz set the end token manually')
+    return end_tokens
     
 if __name__ == '__main__':
     print(get_templates('meta-llama/Llama-2-7b-chat-hf', 'chat'))
\ No newline at end of file